@@ -4,6 +4,22 @@ import subprocess
 
 from typing import Optional
 
+try:
+    import winreg
+except ImportError:
+    winreg = None
+
+
+# the platform never changes at runtime, look it up once
+_PLATFORM = platform.system().lower()
+
+# interface names to guids, and the per interface tcpip settings
+_NETWORK_KEY = (
+    r"SYSTEM\CurrentControlSet\Control\Network"
+    + r"\{4D36E972-E325-11CE-BFC1-08002BE10318}"
+)
+_TCPIP_KEY = r"SYSTEM\CurrentControlSet\Services\Tcpip\Parameters\Interfaces"
+
 
 class Adapter:
     # https://answers.microsoft.com/en-us/windows/forum/all/solved-unable-to-stop-internet-connection-sharing/b01e1ebc-4f9d-4bf6-8d15-37a782fa03ff
@@ -13,6 +29,11 @@ class Adapter:
         self.interface = config.interface
         self.ssid = config.ssid
 
+        # netsh is windows only, stub the commands out once instead of per call
+        if _PLATFORM != "windows":
+            for name in ("connect", "get_dns", "reset_dns", "set_dns"):
+                setattr(self, name, lambda *args, **kwargs: None)
+
     def run_command(self, command: list, success_message: Optional[str] = None):
         try:
             result = subprocess.run(
@@ -34,10 +55,8 @@ class Adapter:
         return None
 
     def supported_platform(self):
-        os = platform.system().lower()
-
-        if os != "windows":
-            logging.warning(f"unsupported platform, {os}. skipping.")
+        if _PLATFORM != "windows":
+            logging.warning(f"unsupported platform, {_PLATFORM}. skipping.")
             return False
 
         return True
@@ -45,17 +64,54 @@ class Adapter:
     # netsh wlan show profiles interface="wi-fi"
     # netsh wlan connect ssid=default name=default
     def connect(self):
-        if not self.supported_platform():
-            return
-
         self.run_command(
             ["netsh", "wlan", "connect", f"ssid={self.ssid}", f"name={self.ssid}"],
             success_message=f"{self.interface.lower()} connected to {self.ssid}!",
         )
 
+    # read the dns servers straight from the registry, no netsh process needed
+    def read_dns(self):
+        hklm = winreg.HKEY_LOCAL_MACHINE
+
+        with winreg.OpenKey(hklm, _NETWORK_KEY) as network:
+            for i in range(winreg.QueryInfoKey(network)[0]):
+                guid = winreg.EnumKey(network, i)
+
+                try:
+                    with winreg.OpenKey(network, rf"{guid}\Connection") as key:
+                        name, _ = winreg.QueryValueEx(key, "Name")
+                except OSError:
+                    continue
+
+                if name.lower() != self.interface.lower():
+                    continue
+
+                servers = {}
+                with winreg.OpenKey(hklm, rf"{_TCPIP_KEY}\{guid}") as key:
+                    for value in ("NameServer", "DhcpNameServer"):
+                        try:
+                            servers[value], _ = winreg.QueryValueEx(key, value)
+                        except OSError:
+                            servers[value] = ""
+
+                return servers
+
+        return None
+
     # netsh interface ipv4 show config wi-fi
     def get_dns(self):
-        if not self.supported_platform():
+        try:
+            servers = self.read_dns()
+        except OSError as err:
+            logging.debug(f"unable to read the registry, {err=}, {type(err)=}")
+            servers = None
+
+        if servers is not None:
+            logging.info(
+                f"current dns configuration for {self.interface.lower()}"
+                + f", static: {servers['NameServer'] or 'none'}"
+                + f", dhcp: {servers['DhcpNameServer'] or 'none'}."
+            )
             return
 
         output = self.run_command(
@@ -67,9 +123,6 @@ class Adapter:
 
     # netsh interface ipv4 set dns wi-fi dhcp
     def reset_dns(self):
-        if not self.supported_platform():
-            return
-
         self.run_command(
             ["netsh", "interface", "ipv4", "set", "dns", self.interface, "dhcp"],
             success_message=f"reset {self.interface} dns settings to automatic.",
@@ -77,9 +130,6 @@ class Adapter:
 
     # netsh interface ipv4 set dns wi-fi static 127.0.0.1 validate=no
     def set_dns(self, primary_dns="127.0.0.1"):
-        if not self.supported_platform():
-            return
-
         self.run_command(
             [
                 "netsh",
@@ -1,15 +1,69 @@
+import asyncio
+import itertools
 import logging
-import time
+import re
+import zlib
 
 from datetime import datetime, timedelta
 
 import httpx
 
-from .models import AdsBlockList, Setting
+from sqlalchemy.dialects.sqlite import insert
+
+from .models import AdsBlockList
+
+
+# hosts file or adblock style line, less the ip, "||" prefix and "^" suffix,
+# cosmetic rules like "example.org##.banner" hide elements, they block nothing
+_DOMAIN_REGEX = re.compile(
+    r"^[ \t]*(?:(?:\d{1,3}(?:\.\d{1,3}){3}|[0-9a-f]*:\S*)[ \t]+|\|\|)?"
+    r"([^\s!#^]++)(?!#[@?$]?#)",
+    re.MULTILINE,
+)
+
+# the standard names at the top of hosts files, not ads
+_HOSTS_PREAMBLE = frozenset(
+    {
+        "0.0.0.0.",
+        "broadcasthost.",
+        "ip6-allhosts.",
+        "ip6-allnodes.",
+        "ip6-allrouters.",
+        "ip6-localhost.",
+        "ip6-localnet.",
+        "ip6-loopback.",
+        "ip6-mcastprefix.",
+        "local.",
+        "localhost.",
+        "localhost.localdomain.",
+    }
+)
+
+
+def is_blocked(blocked_domains, query_name, wildcard=False, allowed_domains=()):
+    if not wildcard:
+        return query_name in blocked_domains
+
+    # walk the parent domains, "a.ads.com." -> "ads.com.", the closest match
+    # wins so a whitelisted subdomain of a blocked parent stays reachable, and
+    # the walk stops before the top-level label
+    index = 0
+    while True:
+        domain = query_name[index:]
+        if domain in allowed_domains:
+            return False
+
+        if domain in blocked_domains:
+            return True
+
+        index = query_name.find(".", index) + 1
+        if not index or query_name.find(".", index) in (-1, len(query_name) - 1):
+            return False
 
 
 class AdsBlock:
     def __init__(self, sqlite, reload=False):
+        self.allowed_domains = set()
         self.blocked_domains = set()
         self.total_domains = 0
 
@@ -17,21 +71,97 @@ class AdsBlock:
         self.session = sqlite.session
         self.sqlite = sqlite
 
-    def get_adsblock_file(self, client, url):
-        for i in range(2):
+        # kept across reloads, so the pooled connections to the list hosts are
+        # reused instead of doing the tcp and tls handshakes again every refresh,
+        # the transport retries failed connects instead of a sleep-and-retry loop
+        self.loop = asyncio.new_event_loop()
+        self.client = httpx.AsyncClient(
+            timeout=9.0,
+            follow_redirects=True,
+            transport=httpx.AsyncHTTPTransport(
+                verify=False,
+                retries=2,
+                limits=httpx.Limits(
+                    max_connections=16,
+                    max_keepalive_connections=16,
+                    keepalive_expiry=60,
+                ),
+            ),
+        )
+
+    def close(self):
+        self.loop.run_until_complete(self.client.aclose())
+        self.loop.close()
+
+    async def get_adsblock_file(self, client, semaphore, url, row):
+        # conditional get, the lists rarely change between reloads
+        headers = {}
+
+        if row and row.contents:
+            if row.etag:
+                headers["if-none-match"] = row.etag
+            if row.last_modified:
+                headers["if-modified-since"] = row.last_modified
+
+        async with semaphore:
             try:
-                response = client.get(url)
-                response.raise_for_status()
-                return self.parse(response)
+                async with client.stream("GET", url, headers=headers) as response:
+                    if response.status_code == 304:
+                        # not modified, reuse the cached contents and skip the sync
+                        await self.parse(url, row.contents)
+                        return None
+
+                    response.raise_for_status()
+
+                    # parse whole lines as the body arrives instead of buffering
+                    # it first, the raw contents are still kept for the 304 path
+                    contents = []
+                    count = 0
+                    tail = ""
+
+                    async for chunk in response.aiter_text():
+                        contents.append(chunk)
+                        lines, _, tail = (tail + chunk).rpartition("\n")
+                        if lines:
+                            count += await self.merge(lines)
+
+                    count += await self.merge(tail)
+
+                    self.total_domains += count
+                    logging.debug(f"+{count}, {url}")
+
+                    return (
+                        url,
+                        "".join(contents),
+                        count,
+                        response.headers.get("etag"),
+                        response.headers.get("last-modified"),
+                    )
 
             except Exception as err:
                 logging.error(f"unexpected {err=}, {type(err)=}, {url}")
-                time.sleep(3)
 
         return None
 
+    async def get_adsblock_files(self, urls):
+        # download the lists concurrently, bounded to a handful at a time
+        semaphore = asyncio.Semaphore(8)
+        rows = self.get_lists(urls)
+
+        return await asyncio.gather(
+            *(
+                self.get_adsblock_file(self.client, semaphore, url, rows.get(url))
+                for url in urls
+            )
+        )
+
+    def get_lists(self, urls):
+        rows = self.session.query(AdsBlockList).filter(AdsBlockList.url.in_(urls)).all()
+        return {row.url: row for row in rows}
+
     def load_blacklist(self, urls):
-        row = self.session.query(Setting).filter_by(key="blocked-stats").first()
+        # only the stats row, the domains blob is never loaded as an entity
+        row = self.sqlite.get("blocked-stats")
 
         if (
             not self.reload
@@ -46,111 +176,131 @@ class AdsBlock:
         logging.info(f"parsing {len(urls)} adblock lists ...")
 
         self.blocked_domains = set()
-        with httpx.Client(verify=False, timeout=9.0) as client:
-            buffers = []
-            for url in urls:
-                buffer = self.get_adsblock_file(client, url)
-                if buffer:
-                    buffers.append(buffer)
-
-            self.sync(buffers)
+        self.total_domains = 0
+        buffers = self.loop.run_until_complete(self.get_adsblock_files(urls))
+        self.sync([buffer for buffer in buffers if buffer])
 
         # blocked_stats
         stats = f"{len(self.blocked_domains)} out of {self.total_domains}"
-        self.sqlite.update("blocked-stats", stats)
+        self.sqlite.update("blocked-stats", stats, commit=False)
 
-        # blocked_domains
-        self.blocked_domains = sorted(self.blocked_domains)
-        self.sqlite.update("blocked-domains", "\n".join(self.blocked_domains))
+        # blocked_domains, compressed as domain lists are very repetitive
+        self.sqlite.update("blocked-domains", None, blob=self.compress(), commit=False)
+
+        # lists and settings land in a single transaction
+        self.session.commit()
 
         logging.info(f"... done, loaded {stats}!")
         return True
 
+    def compress(self):
+        # fed in batches, so the whole list is never joined into one big string
+        compressor = zlib.compressobj()
+        domains = iter(self.blocked_domains)
+        chunks = []
+        separator = b""
+
+        while batch := list(itertools.islice(domains, 8192)):
+            chunks.append(compressor.compress(separator + "\n".join(batch).encode()))
+            separator = b"\n"
+
+        chunks.append(compressor.flush())
+        return b"".join(chunks)
+
     def load_cache(self):
+        settings = self.sqlite.get_values(["blocked-domains", "blocked-stats"])
+
         # blocked_stats
-        row = self.session.query(Setting).filter_by(key="blocked-stats").first()
+        row = settings.get("blocked-stats")
         stats = row.value if row else "0 out of 0"
 
         # blocked_domains
-        row = self.session.query(Setting).filter_by(key="blocked-domains").first()
-        if row:
+        row = settings.get("blocked-domains")
+        if row and row.blob:
+            buffer = zlib.decompress(row.blob).decode()
+            self.blocked_domains = set(buffer.split("\n"))
+
+        elif row and row.value:
             self.blocked_domains = set(row.value.split("\n"))
 
+        # caches written before the hosts preamble was filtered out
+        self.blocked_domains -= _HOSTS_PREAMBLE
+
         logging.info(f"loaded cached blocked domains, {stats}!")
 
     def load_custom(self, lists):
-        count = 0
-        total = 0
-
-        for domain in lists:
-            if domain:
-                total += 1
-                buffer = f"{domain}."
+        buffers = {f"{domain.lower()}." for domain in lists if domain}
+        added = buffers - self.blocked_domains
+        self.blocked_domains |= added
 
-                if buffer not in self.blocked_domains:
-                    self.blocked_domains.add(buffer)
-                    count += 1
-                    logging.debug(f"blacklisted {buffer}")
+        for domain in added:
+            logging.debug(f"blacklisted {domain}")
 
-        logging.info(f"loaded custom blacklist, {count} out of {total}!")
+        logging.info(f"loaded custom blacklist, {len(added)} out of {len(buffers)}!")
 
     def load_whitelist(self, lists):
-        count = 0
-        total = 0
+        buffers = {f"{domain.lower()}." for domain in lists if domain}
+        self.allowed_domains = buffers
 
-        for domain in lists:
-            if domain:
-                total += 1
-                buffer = f"{domain}."
+        removed = buffers & self.blocked_domains
+        self.blocked_domains -= removed
 
-                if buffer in self.blocked_domains:
-                    self.blocked_domains.remove(buffer)
-                    count += 1
-                    logging.debug(f"whitelisted {buffer}")
+        for domain in removed:
+            logging.debug(f"whitelisted {domain}")
 
-        logging.info(f"loaded whitelist, {count} out of {total}!")
+        logging.info(f"loaded whitelist, {len(removed)} out of {len(buffers)}!")
 
-    def parse(self, response):
-        url = str(response.url)
-        count = 0
+    def extract(self, contents):
+        # one pass over the whole list instead of a python loop per line, and
+        # lowercased in one go rather than per domain
+        matches = _DOMAIN_REGEX.findall(contents.lower())
+        domains = {f"{match}." for match in matches}
+        domains -= _HOSTS_PREAMBLE
 
-        for line in response.text.splitlines():
-            line = line.strip()
+        return domains, len(matches)
 
-            if line and not line.startswith(("!", "#")):
-                domain = line.split()[0].replace("||", "").replace("^", "") + "."
-                self.blocked_domains.add(domain)
-                count += 1
-                # logging.debug(f"parsed {domain} from {line}")
+    async def merge(self, contents):
+        # extract in a worker thread so the other downloads keep flowing, then
+        # merge here on the event loop so no lock is needed
+        domains, count = await asyncio.to_thread(self.extract, contents)
+        self.blocked_domains |= domains
+
+        return count
+
+    async def parse(self, url, contents):
+        count = await self.merge(contents)
 
         self.total_domains += count
         logging.debug(f"+{count}, {url}")
 
-        return url, response.text, count
+        return count
 
     def sync(self, buffers):
         if not buffers:
             return
 
-        for url, contents, count in buffers:
-            row = self.session.query(AdsBlockList).filter_by(url=url).first()
-            dt = datetime.utcnow()
-
-            if row:
-                row.contents = contents
-                row.count = count
-                row.updated_on = dt
-
-            else:
-                row = AdsBlockList(
-                    url=url,
-                    is_active=True,
-                    contents=contents,
-                    count=count,
-                    created_on=dt,
-                    updated_on=dt,
-                )
-
-                self.session.add(row)
-
-        self.session.commit()
+        # one upsert for every list instead of a select and write per url
+        dt = datetime.utcnow()
+        rows = [
+            {
+                "url": url,
+                "is_active": True,
+                "contents": contents,
+                "count": count,
+                "etag": etag,
+                "last_modified": last_modified,
+                "created_on": dt,
+                "updated_on": dt,
+            }
+            for url, contents, count, etag, last_modified in buffers
+        ]
+
+        statement = insert(AdsBlockList).values(rows)
+        columns = ("contents", "count", "etag", "last_modified", "updated_on")
+
+        self.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[AdsBlockList.url],
+                set_={column: statement.excluded[column] for column in columns},
+            )
+        )
@@ -0,0 +1,86 @@
+import threading
+
+from concurrent.futures import Future
+
+import cachetools
+import dns.flags
+import dns.message
+
+
+def min_ttl(response, default):
+    # shortest ttl of the answer, or of the soa for negative answers
+    return min(
+        (rrset.ttl for rrset in response.answer or response.authority), default=default
+    )
+
+
+def copy_reply(query, result, dnssec=False):
+    # the leader's answer rebuilt for a coalesced query, when it did not make it
+    # into the cache, with every section and the ra, aa and ad bits kept
+    response = dns.message.make_response(query)
+    response.set_rcode(result.rcode())
+
+    keep = dns.flags.AA | dns.flags.RA
+    if dnssec or query.flags & dns.flags.AD:
+        keep |= dns.flags.AD
+
+    response.flags |= (result.flags & keep) | (query.flags & dns.flags.CD)
+    response.answer = result.answer
+    response.authority = result.authority
+    response.additional = result.additional
+    return response
+
+
+class InFlight:
+    # coalesce concurrent lookups of the same key, the first caller forwards
+    # the query while the others wait on its future instead of sleeping
+
+    def __init__(self):
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def claim(self, key):
+        with self.lock:
+            future = self.futures.get(key)
+            if future:
+                return future, False
+
+            future = self.futures[key] = Future()
+            return future, True
+
+    def release(self, key, result):
+        with self.lock:
+            future = self.futures.pop(key, None)
+
+        if future:
+            future.set_result(result)
+
+    def wait(self, future, timeout):
+        try:
+            return future.result(timeout=timeout)
+        except Exception:
+            return None
+
+
+class ShardedCache:
+    # ttl aware lru cache split into shards, each behind its own lock, since
+    # cachetools caches are not thread safe and every handler thread uses it
+
+    def __init__(self, maxsize, ttu, shards=16):
+        self.shards = [
+            (threading.Lock(), cachetools.TLRUCache(max(maxsize // shards, 1), ttu))
+            for _ in range(shards)
+        ]
+
+    def shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key, default=None):
+        lock, cache = self.shard(key)
+        with lock:
+            return cache.get(key, default)
+
+    def __setitem__(self, key, value):
+        lock, cache = self.shard(key)
+        with lock:
+            cache[key] = value
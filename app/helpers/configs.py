@@ -1,17 +1,33 @@
 import hashlib
 import socket
 
-from datetime import datetime
 from pathlib import Path
 
 import yaml
 
-from .models import Setting
+try:
+    from yaml import CSafeLoader as SafeLoader  # libyaml bindings, when available
+except ImportError:
+    from yaml import SafeLoader
+
+from .cache import InFlight
+
+
+# the hostname does not change while running, resolve it once
+_CUSTOM_DNS = {
+    "1.0.0.127.in-addr.arpa.": "127.0.0.1",
+    "localhost.": "127.0.0.1",
+    f"{socket.gethostname().lower()}.": "127.0.0.1",
+}
 
 
 class Base:
-    def __str__(self):
-        return str([{i: f"{self.__dict__[i]}"} for i in self.__dict__])
+    def __repr__(self):
+        return f"{type(self).__name__}({self.__dict__})"
+
+    # copy the keys as is, all looked up before any is assigned
+    def update(self, configs, keys):
+        self.__dict__.update({key: configs[key] for key in keys})
 
 
 # default configs, overide as needed
@@ -28,6 +44,7 @@ class Config(Base):
             self.custom = ()
             self.reload = False
             self.whitelist = ()
+            self.wildcard = False
 
     class Cache(Base):
         def __init__(self):
@@ -35,7 +52,7 @@ class Config(Base):
             self.enable = True
             self.max_size = 1000
             self.ttl = 300
-            self.wip = set()
+            self.wip = InFlight()
 
     class DNS(Base):
         def __init__(self):
@@ -44,11 +61,7 @@ class Config(Base):
             self.target_doh = ["https://1.1.1.1/dns-query"]
             self.target_mode = "dns-message"
 
-            self.custom = {
-                "1.0.0.127.in-addr.arpa.": "127.0.0.1",
-                "localhost.": "127.0.0.1",
-                f"{socket.gethostname().lower()}.": "127.0.0.1",
-            }
+            self.custom = dict(_CUSTOM_DNS)
 
     class DOH(Base):
         def __init__(self):
@@ -78,6 +91,10 @@ class Config(Base):
         self.filepath = Path(".").resolve()
         self.secret_key = "the-quick-brown-fox-jumps-over-the-lazy-dog!"
 
+        # last loaded file, (mtime, size) and its sha256
+        self.stat = None
+        self.sha256 = None
+
         self.adapter = self.Adapter()
         self.adsblock = self.AdsBlock()
         self.cache = self.Cache()
@@ -95,87 +112,68 @@ class Config(Base):
             print(f"config file {self.filename} not found, using defaults.")
             return None
 
-        sha256 = hashlib.sha256()
-        with file.open("rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                sha256.update(chunk)
+        # untouched since the last load, skip the read, hash and parse
+        stat = file.stat()
+        if self.sha256 and (stat.st_mtime_ns, stat.st_size) == self.stat:
+            return self.sha256
+
+        # one read, hashed and parsed from the same buffer
+        data = file.read_bytes()
+        sha256 = hashlib.sha256(data)
 
         try:
-            with file.open("r") as f:
-                configs = yaml.load(f, Loader=yaml.loader.SafeLoader)
-
-                self.adapter.enable = configs["adapter"]["enable"]
-                self.adapter.interface = configs["adapter"]["interface"]
-                self.adapter.ssid = configs["adapter"]["ssid"]
-
-                self.adsblock.blacklist = sorted(configs["adblock"]["blacklist"])
-                self.adsblock.custom = set(configs["adblock"]["custom"])
-                self.adsblock.reload = configs["adblock"]["reload"]
-                self.adsblock.whitelist = set(configs["adblock"]["whitelist"])
-
-                self.cache.enable = configs["cache"]["enable"]
-                self.cache.max_size = configs["cache"]["max_size"]
-                self.cache.ttl = configs["cache"]["ttl"]
-
-                self.dns.hostname = configs["dns"]["hostname"]
-                self.dns.port = configs["dns"]["port"]
-                self.dns.target_doh = configs["dns"]["target_doh"]
-                self.dns.target_mode = configs["dns"]["target_mode"]
-
-                buffers = {
-                    "1.0.0.127.in-addr.arpa.": "127.0.0.1",
-                    "localhost.": "127.0.0.1",
-                    f"{socket.gethostname().lower()}.": "127.0.0.1",
-                }
-                for item in configs["dns"]["custom"]:
-                    try:
-                        key, value = item.split(":")
-                        buffers[f"{key.lower()}."] = value
-                    except ValueError:
-                        print(f"invalid custom dns: {item}")
-
-                self.dns.custom = [
-                    {key: value} for key, value in sorted(buffers.items())
-                ]
-
-                self.doh.hostname = configs["doh"]["hostname"]
-                self.doh.port = configs["doh"]["port"]
-
-                self.logging.level = configs["logging"]["level"].upper()
-
-                self.web.enable = configs["web"]["enable"]
-                self.web.hostname = configs["web"]["hostname"]
-                self.web.port = configs["web"]["port"]
+            configs = yaml.load(data, Loader=SafeLoader)
+
+            self.adapter.update(configs["adapter"], ("enable", "interface", "ssid"))
+
+            self.adsblock.blacklist = sorted(configs["adblock"]["blacklist"])
+            self.adsblock.custom = set(configs["adblock"]["custom"])
+            self.adsblock.reload = configs["adblock"]["reload"]
+            self.adsblock.whitelist = set(configs["adblock"]["whitelist"])
+            self.adsblock.wildcard = configs["adblock"].get("wildcard", False)
+
+            self.cache.update(configs["cache"], ("enable", "max_size", "ttl"))
+
+            self.dns.update(
+                configs["dns"], ("hostname", "port", "target_doh", "target_mode")
+            )
+            if self.dns.target_mode == "dns-json":
+                print("dns-json target mode is slower, dns-message is preferred.")
+
+            buffers = dict(_CUSTOM_DNS)
+            for item in configs["dns"]["custom"]:
+                key, separator, value = item.partition(":")
+                if not separator:
+                    print(f"invalid custom dns: {item}")
+                    continue
+
+                buffers[f"{key.lower()}."] = value
+
+            self.dns.custom = dict(sorted(buffers.items()))
+
+            self.doh.update(configs["doh"], ("hostname", "port"))
+
+            self.logging.level = configs["logging"]["level"].upper()
+
+            self.web.update(configs["web"], ("enable", "hostname", "port"))
 
         except Exception as err:
             print(f"unexpected {err=}, {type(err)=}")
             return None
 
-        return sha256.hexdigest()
+        self.stat = (stat.st_mtime_ns, stat.st_size)
+        self.sha256 = sha256.hexdigest()
+        return self.sha256
 
     # in case config file is different
-    def sync(self, session):
+    def sync(self, sqlite):
         sha256 = self.load()
         if not sha256:
             return None
 
-        row = session.query(Setting).filter_by(key="config-sha256").first()
-        dt = datetime.utcnow()
+        row = sqlite.get("config-sha256")
 
         if row and sha256 == row.value:
             return None  # no changes detected
 
-        if row:
-            row.value = sha256
-            row.updated_on = dt
-        else:
-            row = Setting(
-                key="config-sha256",
-                value=sha256,
-                created_on=dt,
-                updated_on=dt,
-            )
-            session.add(row)
-
-        session.commit()
-        return dt
+        return sqlite.update("config-sha256", sha256)
@@ -1,110 +1,165 @@
 import logging
-import random
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from socketserver import BaseRequestHandler, ThreadingUDPServer
 
 import dns.message
 import dns.query
 import dns.rdatatype
-import httpx
+
+from .adsblock import is_blocked
+from .cache import copy_reply, min_ttl
+from .upstream import DNS_JSON_HEADERS, DNS_MESSAGE_HEADERS, Upstream
+from .wire import (
+    age_reply,
+    dnssec_ok,
+    make_custom,
+    make_error,
+    parse_question,
+    patch_reply,
+    strip_opt,
+    ttl_offsets,
+    type_text,
+)
 
 
 class DNSHandler(BaseRequestHandler):
     def send_response(self, socket, response):
+        self.send_wire(socket, response.to_wire())
+
+    def send_wire(self, socket, wire):
         try:
-            socket.sendto(response.to_wire(), self.client_address)
+            socket.sendto(wire, self.client_address)
         except Exception as e:
             logging.error(f"{self.client_address} error replying: {e}")
 
+    def send_cached(self, socket, data, cache_keyname, dnssec):
+        cached = self.server.cache.get(cache_keyname)
+        if not cached:
+            return False
+
+        # the upstream answer with the flags of this query and the ttls aged
+        wire = patch_reply(cached["wire"], data, dnssec)
+        age_reply(wire, cached["ttls"], int(time.time() - cached["timestamp"]))
+
+        logging.info(f"{self.client_address} cache-hit: {cache_keyname}")
+        self.send_wire(socket, wire)
+        return True
+
     def handle(self):
-        logging.debug(f"{self.client_address} request data: {self.request}")
+        logging.debug("%s request data: %s", self.client_address, self.request)
 
         data = self.request[0]  # .strip()
         socket = self.request[1]
 
+        # cache hit, answered from the wire question without a full parse ########
+        question = parse_question(data) if self.server.cache_enable else None
+        if question:
+            query_name, query_type = question
+
+            # answers with dnssec records are cached apart, for queries with do
+            dnssec = dnssec_ok(data)
+            cache_keyname = f"{query_name}:{query_type}" + (":do" if dnssec else "")
+
+            # the lists are lowercase, the question keeps the case of the client
+            lookup_name = query_name.lower()
+
+            if (
+                lookup_name not in self.server.dns_custom
+                and not is_blocked(
+                    self.server.blocked_domains,
+                    lookup_name,
+                    self.server.blocked_wildcard,
+                    self.server.allowed_domains,
+                )
+                and self.send_cached(socket, data, cache_keyname, dnssec)
+            ):
+                return
+
         # parse dns message ######################################################
         try:
             dns_query = dns.message.from_wire(data)
             query_name = str(dns_query.question[0].name)
 
             dns_type = dns_query.question[0].rdtype
-            query_type = dns.rdatatype.to_text(dns_type)
+            query_type = type_text(dns_type)
 
             cache_keyname = f"{query_name}:{query_type}"
-            logging.debug(f"{self.client_address} received: {query_name} {query_type}")
+            lookup_name = query_name.lower()
+            logging.debug(
+                "%s received: %s %s", self.client_address, query_name, query_type
+            )
 
         except Exception as e:
-            response = dns.message.Message()
-            response.set_rcode(dns.rcode.FORMERR)
-
             logging.error(
                 f"{self.client_address} error invalid query: {e}"
                 + f"\n{self.request}\n{data.hex()}"
             )
-            self.send_response(socket, response)
+            self.send_wire(socket, make_error(data, dns.rcode.FORMERR))
             return
 
         # custom dns #############################################################
-        if query_name in self.server.dns_custom and query_type in ["PTR", "A"]:
-            response = dns.message.make_response(dns_query)
-            rrset = dns.rrset.from_text(
-                query_name,
-                300,
-                dns.rdataclass.IN,
-                dns.rdatatype.A,
-                self.server.dns_custom[query_name],
-            )
-            response.answer.append(rrset)
-
+        wire = self.server.custom_answers.get(f"{lookup_name}:{query_type}")
+        if wire:
             logging.info(f"{self.client_address} custom-hit: {cache_keyname}")
-            self.send_response(socket, response)
+            self.send_wire(socket, patch_reply(wire, data))
             return
 
         # blocked domain #########################################################
-        if query_name in self.server.blocked_domains:
-            response = dns.message.make_response(dns_query)
-            response.set_rcode(dns.rcode.NXDOMAIN)
-
+        if is_blocked(
+            self.server.blocked_domains,
+            lookup_name,
+            self.server.blocked_wildcard,
+            self.server.allowed_domains,
+        ):
             logging.info(f"{self.client_address} blacklisted: {cache_keyname}")
-            self.send_response(socket, response)
+            self.send_wire(socket, make_error(data, dns.rcode.NXDOMAIN))
             return
 
         # cache ##################################################################
+        # answers with dnssec records are cached apart, for queries with do
+        dnssec = bool(dns_query.ednsflags & dns.flags.DO)
+        if dnssec:
+            cache_keyname += ":do"
+
+        leader = False
         if self.server.cache_enable:
-            if cache_keyname in self.server.cache_wip:
-                time.sleep(3)
+            if self.send_cached(socket, data, cache_keyname, dnssec):
+                return
 
-            if cache_keyname in self.server.cache:
-                response = dns.message.make_response(dns_query)
-                response.answer = self.server.cache[cache_keyname]["response"]
-                # response = dns.message.from_wire(cached_response["response"])
+            future, leader = self.server.cache_wip.claim(cache_keyname)
+            if not leader:
+                # same query already forwarded, reuse its answer when it lands
+                result = self.server.cache_wip.wait(
+                    future, self.server.upstream.deadline
+                )
+                logging.info(f"{self.client_address} coalesced: {cache_keyname}")
 
-                logging.info(f"{self.client_address} cache-hit: {cache_keyname}")
-                self.send_response(socket, response)
-                return
+                if not result:
+                    self.send_wire(socket, make_error(data, dns.rcode.SERVFAIL))
+                    return
 
-            else:
-                self.server.cache_wip.add(cache_keyname)
+                # the same reply as a cache hit, from the entry the leader wrote
+                if not self.send_cached(socket, data, cache_keyname, dnssec):
+                    self.send_response(socket, copy_reply(dns_query, result, dnssec))
+
+                return
 
         try:
-            target_doh = random.choice(self.server.target_doh)
+            target_doh = self.server.upstream.pick()
             logging.info(
                 f"{self.client_address} forward: {cache_keyname}, {target_doh}"
             )
 
             # dns-json ###########################################################
             if self.server.target_mode == "dns-json":
-                headers = {
-                    "accept": "application/dns-json",
-                    "accept-encoding": "gzip",
-                }
                 params = {"name": query_name, "type": query_type}
 
-                doh_response = httpx.get(
-                    target_doh, headers=headers, params=params, timeout=9.0
+                doh_response = self.server.upstream.request(
+                    "GET", target_doh, headers=DNS_JSON_HEADERS, params=params
                 )
-                doh_response.raise_for_status()
 
                 doh_response_json = doh_response.json()
                 response = dns.message.make_response(dns_query)
@@ -114,9 +169,7 @@ class DNSHandler(BaseRequestHandler):
                         query_name,
                         answer["TTL"],
                         dns.rdataclass.IN,
-                        dns.rdatatype.from_text(
-                            dns.rdatatype.to_text(answer["type"]),
-                        ),
+                        dns.rdatatype.RdataType.make(answer["type"]),
                         answer["data"],
                     )
 
@@ -124,31 +177,29 @@ class DNSHandler(BaseRequestHandler):
 
             # dns-message ########################################################
             else:
-                headers = {
-                    "content-type": "application/dns-message",
-                    "accept": "application/dns-message",
-                    "accept-encoding": "gzip",
-                }
-
-                doh_response = httpx.post(
+                doh_response = self.server.upstream.request(
+                    "POST",
                     target_doh,
-                    headers=headers,
+                    headers=DNS_MESSAGE_HEADERS,
                     content=dns_query.to_wire(),
-                    timeout=9.0,
                 )
-                doh_response.raise_for_status()
 
                 response = dns.message.from_wire(doh_response.content)
 
-            logging.debug(
-                f"{self.client_address} response message: {response.to_text()}"
-            )
+            # to_text walks every record, only pay for it when debugging
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug(
+                    f"{self.client_address} response message: {response.to_text()}"
+                )
 
             # cache ##############################################################
             if self.server.cache_enable:
+                wire = strip_opt(response.to_wire())
                 self.server.cache[cache_keyname] = {
-                    "response": response.answer,
+                    "wire": wire,
+                    "ttls": ttl_offsets(wire),
                     "timestamp": time.time(),
+                    "ttl": min_ttl(response, self.server.cache_ttl),
                 }
 
         except Exception as e:
@@ -161,29 +212,52 @@ class DNSHandler(BaseRequestHandler):
             response.set_rcode(dns.rcode.SERVFAIL)
 
         finally:
-            if self.server.cache_enable:
-                self.server.cache_wip.discard(cache_keyname)
+            if leader:
+                self.server.cache_wip.release(cache_keyname, response)
 
             self.send_response(socket, response)
 
 
 class DNSServer(ThreadingUDPServer):
-    def __init__(self, config, sqlite, blocked_domains):
+    def __init__(self, config, sqlite, blocked_domains, allowed_domains):
         self.cache_enable = config.cache.enable
         self.cache_wip = config.cache.wip
         self.cache = config.cache.cache
+        self.cache_ttl = config.cache.ttl
 
         self.dns_custom = config.dns.custom
+        self.custom_answers = make_custom(config.dns.custom)
         self.target_doh = config.dns.target_doh
         self.target_mode = config.dns.target_mode
+        self.upstream = Upstream(config.dns.target_doh)
 
+        self.allowed_domains = allowed_domains
         self.blocked_domains = blocked_domains
+        self.blocked_wildcard = config.adsblock.wildcard
 
         self.session = sqlite.session
         self.sqlite = sqlite
 
+        # a fixed pool of handler threads instead of a new thread per packet,
+        # past the backlog new packets are dropped as if lost on the wire
+        self.executor = ThreadPoolExecutor(max_workers=64)
+        self.backlog = threading.BoundedSemaphore(4096)
+
         super().__init__((config.dns.hostname, config.dns.port), DNSHandler)
 
         logging.info(
             f"local dns server running on {config.dns.hostname}:{config.dns.port}."
         )
+
+    def process_request(self, request, client_address):
+        if not self.backlog.acquire(blocking=False):
+            logging.debug("%s dropped, too many pending queries", client_address)
+            return
+
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.backlog.release()
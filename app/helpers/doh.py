@@ -1,6 +1,5 @@
 import base64
 import logging
-import random
 import ssl
 import time
 
@@ -10,7 +9,18 @@ from urllib.parse import urlparse, parse_qs
 import dns.message
 import dns.query
 import dns.rdatatype
-import httpx
+
+from .adsblock import is_blocked
+from .cache import copy_reply, min_ttl
+from .upstream import DNS_JSON_HEADERS, DNS_MESSAGE_HEADERS, Upstream
+from .wire import (
+    age_reply,
+    make_custom,
+    patch_reply,
+    strip_opt,
+    ttl_offsets,
+    type_text,
+)
 
 
 class DOHHandler(BaseHTTPRequestHandler):
@@ -23,66 +33,91 @@ class DOHHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(response_data)
 
+    def send_cached(self, dns_query, cache_keyname, dnssec):
+        cached = self.server.cache.get(cache_keyname)
+        if not cached:
+            return False
+
+        # the upstream answer with the flags of this query and the ttls aged
+        header = (dns_query.id << 16 | dns_query.flags).to_bytes(4, "big")
+        wire = patch_reply(cached["wire"], header, dnssec)
+        age_reply(wire, cached["ttls"], int(time.time() - cached["timestamp"]))
+
+        logging.info(f"{self.client_address} cache-hit: {cache_keyname}")
+        self.do_response(200, "application/dns-message", bytes(wire))
+        return True
+
     def do_something(self, dns_query, query_name, query_type):
         cache_keyname = f"{query_name}:{query_type}"
-        logging.debug(f"{self.client_address} received: {query_name} {query_type}")
+        logging.debug("%s received: %s %s", self.client_address, query_name, query_type)
+
+        # the lists are lowercase, the question keeps the case of the client
+        lookup_name = query_name.lower()
 
         # custom dns #############################################################
-        if query_name in self.server.dns_custom and query_type in ["PTR", "A"]:
-            response = dns.message.make_response(dns_query)
-            rrset = dns.rrset.from_text(
-                query_name,
-                300,
-                dns.rdataclass.IN,
-                dns.rdatatype.A,
-                self.server.dns_custom[query_name],
-            )
-            response.answer.append(rrset)
+        wire = self.server.custom_answers.get(f"{lookup_name}:{query_type}")
+        if wire:
+            header = (dns_query.id << 16 | dns_query.flags).to_bytes(4, "big")
 
             logging.info(f"{self.client_address} custom-hit: {cache_keyname}")
-            self.do_response(200, "application/dns-message", response.to_wire())
+            self.do_response(200, "application/dns-message", patch_reply(wire, header))
             return
 
         # blocked domain #########################################################
-        if query_name in self.server.blocked_domains:
+        if is_blocked(
+            self.server.blocked_domains,
+            lookup_name,
+            self.server.blocked_wildcard,
+            self.server.allowed_domains,
+        ):
             logging.info(f"{self.client_address} blacklisted: {cache_keyname}")
             self.send_error(400, "bad request: blacklisted")
             return
 
         # cache ##################################################################
+        # answers with dnssec records are cached apart, for queries with do
+        dnssec = bool(dns_query.ednsflags & dns.flags.DO)
+        if dnssec:
+            cache_keyname += ":do"
+
+        leader = False
         if self.server.cache_enable:
-            if cache_keyname in self.server.cache_wip:
-                time.sleep(3)
+            if self.send_cached(dns_query, cache_keyname, dnssec):
+                return
+
+            future, leader = self.server.cache_wip.claim(cache_keyname)
+            if not leader:
+                # same query already forwarded, reuse its answer when it lands
+                result = self.server.cache_wip.wait(
+                    future, self.server.upstream.deadline
+                )
+                if not result:
+                    self.send_error(500, "internal server error")
+                    return
 
-            if cache_keyname in self.server.cache:
-                response = dns.message.make_response(dns_query)
-                response.answer = self.server.cache[cache_keyname]["response"]
+                logging.info(f"{self.client_address} coalesced: {cache_keyname}")
 
-                logging.info(f"{self.client_address} cache-hit: {cache_keyname}")
-                self.do_response(200, "application/dns-message", response.to_wire())
-                return
+                # the same reply as a cache hit, from the entry the leader wrote
+                if not self.send_cached(dns_query, cache_keyname, dnssec):
+                    response = copy_reply(dns_query, result, dnssec)
+                    self.do_response(200, "application/dns-message", response.to_wire())
 
-            else:
-                self.server.cache_wip.add(cache_keyname)
+                return
 
+        response = None
         try:
-            target_doh = random.choice(self.server.target_doh)
+            target_doh = self.server.upstream.pick()
             logging.info(
                 f"{self.client_address} forward: {cache_keyname}, {target_doh}"
             )
 
             # dns-json ###########################################################
             if self.server.target_mode == "dns-json":
-                headers = {
-                    "accept": "application/dns-json",
-                    "accept-encoding": "gzip",
-                }
                 params = {"name": query_name, "type": query_type}
 
-                doh_response = httpx.get(
-                    target_doh, headers=headers, params=params, timeout=9.0
+                doh_response = self.server.upstream.request(
+                    "GET", target_doh, headers=DNS_JSON_HEADERS, params=params
                 )
-                doh_response.raise_for_status()
 
                 doh_response_json = doh_response.json()
                 response = dns.message.make_response(
@@ -94,9 +129,7 @@ class DOHHandler(BaseHTTPRequestHandler):
                         query_name,
                         answer["TTL"],
                         dns.rdataclass.IN,
-                        dns.rdatatype.from_text(
-                            dns.rdatatype.to_text(answer["type"]),
-                        ),
+                        dns.rdatatype.RdataType.make(answer["type"]),
                         answer["data"],
                     )
 
@@ -104,31 +137,29 @@ class DOHHandler(BaseHTTPRequestHandler):
 
             # dns-message ########################################################
             else:
-                headers = {
-                    "content-type": "application/dns-message",
-                    "accept": "application/dns-message",
-                    "accept-encoding": "gzip",
-                }
-
-                doh_response = httpx.post(
+                doh_response = self.server.upstream.request(
+                    "POST",
                     target_doh,
-                    headers=headers,
+                    headers=DNS_MESSAGE_HEADERS,
                     content=dns_query.to_wire(),
-                    timeout=9.0,
                 )
-                doh_response.raise_for_status()
 
                 response = dns.message.from_wire(doh_response.content)
 
-            logging.debug(
-                f"{self.client_address} response message: {response.to_text()}"
-            )
+            # to_text walks every record, only pay for it when debugging
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug(
+                    f"{self.client_address} response message: {response.to_text()}"
+                )
 
             # cache ##############################################################
             if self.server.cache_enable:
+                wire = strip_opt(response.to_wire())
                 self.server.cache[cache_keyname] = {
-                    "response": response.answer,
+                    "wire": wire,
+                    "ttls": ttl_offsets(wire),
                     "timestamp": time.time(),
+                    "ttl": min_ttl(response, self.server.cache_ttl),
                 }
 
             self.do_response(200, "application/dns-message", response.to_wire())
@@ -138,13 +169,13 @@ class DOHHandler(BaseHTTPRequestHandler):
             self.send_error(500, "internal server error")
 
         finally:
-            if self.server.cache_enable:
-                self.server.cache_wip.discard(cache_keyname)
+            if leader:
+                self.server.cache_wip.release(cache_keyname, response)
 
     # curl -kvH "accept: application/dns-message"
     #   "https://127.0.0.1:5053/dns-query?dns=q80BAAABAAAAAAAAA3d3dwdleGFtcGxlA2NvbQAAAQAB"
     def do_GET(self):
-        logging.debug(f"{self.client_address} request data: {self.request}")
+        logging.debug("%s request data: %s", self.client_address, self.request)
 
         parsed_path = urlparse(self.path)
         params = parse_qs(parsed_path.query)
@@ -164,7 +195,7 @@ class DOHHandler(BaseHTTPRequestHandler):
             query_name = str(dns_query.question[0].name)
 
             dns_type = dns_query.question[0].rdtype
-            query_type = dns.rdatatype.to_text(dns_type)
+            query_type = type_text(dns_type)
 
         except Exception as e:
             logging.error(
@@ -175,7 +206,7 @@ class DOHHandler(BaseHTTPRequestHandler):
         self.do_something(dns_query, query_name, query_type)
 
     def do_POST(self):
-        logging.debug(f"{self.client_address} request data: {self.request}")
+        logging.debug("%s request data: %s", self.client_address, self.request)
 
         if self.headers.get("Content-Type") != "application/dns-message":
             logging.error(
@@ -193,7 +224,7 @@ class DOHHandler(BaseHTTPRequestHandler):
             query_name = str(dns_query.question[0].name)
 
             dns_type = dns_query.question[0].rdtype
-            query_type = dns.rdatatype.to_text(dns_type)
+            query_type = type_text(dns_type)
 
             self.do_something(dns_query, query_name, query_type)
 
@@ -207,16 +238,21 @@ class DOHHandler(BaseHTTPRequestHandler):
 
 
 class DOHServer(ThreadingHTTPServer):
-    def __init__(self, config, sqlite, blocked_domains):
+    def __init__(self, config, sqlite, blocked_domains, allowed_domains):
         self.cache_enable = config.cache.enable
         self.cache_wip = config.cache.wip
         self.cache = config.cache.cache
+        self.cache_ttl = config.cache.ttl
 
         self.dns_custom = config.dns.custom
+        self.custom_answers = make_custom(config.dns.custom)
         self.target_doh = config.dns.target_doh
         self.target_mode = config.dns.target_mode
+        self.upstream = Upstream(config.dns.target_doh)
 
+        self.allowed_domains = allowed_domains
         self.blocked_domains = blocked_domains
+        self.blocked_wildcard = config.adsblock.wildcard
         self.filepath = config.filepath
 
         self.session = sqlite.session
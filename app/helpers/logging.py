@@ -9,19 +9,19 @@ class SQLiteHandler(logging.Handler):
     def __init__(self, config, sqlite):
         super().__init__()
 
-        self.session = sqlite.session
         self.sqlite = sqlite
 
     def emit(self, message):
         dt = datetime.utcfromtimestamp(message.created)
 
-        row = AdsBlockLog(
-            module=message.module,
-            key=message.levelname.lower(),
-            value=message.getMessage(),
-            created_on=dt,
-            updated_on=dt,
+        # queued, the sqlite thread inserts them in batches
+        self.sqlite.write(
+            AdsBlockLog,
+            {
+                "module": message.module,
+                "key": message.levelname.lower(),
+                "value": message.getMessage(),
+                "created_on": dt,
+                "updated_on": dt,
+            },
         )
-
-        self.session.add(row)
-        self.session.commit()
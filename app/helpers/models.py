@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import Boolean, Column, DateTime, Integer, Text
+from sqlalchemy import Boolean, Column, DateTime, Integer, LargeBinary, Text
 from sqlalchemy.orm import declarative_base
 
 
@@ -27,6 +27,8 @@ class AdsBlockList(Base):
     is_active = Column(Boolean, index=True)
     contents = Column(Text)
     count = Column(Integer)
+    etag = Column(Text)
+    last_modified = Column(Text)
 
     created_on = Column(DateTime, default=datetime.utcnow())
     updated_on = Column(DateTime, default=datetime.utcnow())
@@ -48,8 +50,9 @@ class Setting(Base):
     __tablename__ = "settings"
     id = Column(Integer, primary_key=True)
 
-    key = Column(Text)
+    key = Column(Text, index=True, unique=True)
     value = Column(Text)
+    blob = Column(LargeBinary)
 
     created_on = Column(DateTime, default=datetime.utcnow())
     updated_on = Column(DateTime, default=datetime.utcnow())
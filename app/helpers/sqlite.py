@@ -1,84 +1,158 @@
+import queue
+import sys
 import threading
 
 from datetime import datetime
 
-from sqlalchemy import create_engine
+from sqlalchemy import bindparam, create_engine, event, inspect, select
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import declarative_base, scoped_session, sessionmaker
 
 from .models import Base, AdsBlockDomain, AdsBlockList, AdsBlockLog, Setting
 
 
+# built once, sqlalchemy reuses the compiled sql on every lookup
+_SETTING_BY_KEY = select(Setting).where(Setting.key == bindparam("key"))
+_SETTING_VALUES_BY_KEYS = select(Setting.key, Setting.value, Setting.blob).where(
+    Setting.key.in_(bindparam("keys", expanding=True))
+)
+
+
 class SQLite:
     def __init__(self, uri):
         engine = create_engine(uri)
 
-        # apply sqlite concurrency tuning
-        with engine.connect() as conn:
-            conn.connection.execute(
+        # apply sqlite concurrency tuning, on every pooled connection as most of
+        # these pragmas only last for the connection they were run on
+        @event.listens_for(engine, "connect")
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.execute(
                 "PRAGMA journal_mode=WAL;"
             )  # enable Write-Ahead Logging
-            conn.connection.execute(
+            dbapi_connection.execute(
                 "PRAGMA synchronous=NORMAL;"
             )  # reduce sync overhead
-            conn.connection.execute(
+            dbapi_connection.execute(
                 "PRAGMA cache_size=-16000;"
             )  # set cache size (negative for KB)
-            conn.connection.execute(
+            dbapi_connection.execute(
                 "PRAGMA temp_store=MEMORY;"
             )  # use memory for temporary tables
-            conn.connection.execute(
+            dbapi_connection.execute(
                 "PRAGMA locking_mode=NORMAL;"
             )  # avoid exclusive locking
 
-        Session = scoped_session(sessionmaker(bind=engine))
-        self.session = Session()
+        self.Session = scoped_session(sessionmaker(bind=engine))
+        self.session = self.Session()
 
         Base.metadata.create_all(engine)
+        self.migrate(engine)
+
+        # rows queued by write(), inserted in batches by serve_forever
+        self.batch_size = 500
+        self.command_queue = queue.SimpleQueue()
         self.running = True
 
+    def migrate(self, engine):
+        # add columns and indexes introduced after the cache was first created
+        inspector = inspect(engine)
+
+        with engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                columns = {c["name"] for c in inspector.get_columns(table.name)}
+                indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+
+                for column in table.columns:
+                    if column.name not in columns:
+                        conn.exec_driver_sql(
+                            f"ALTER TABLE {table.name} ADD COLUMN {column.name}"
+                            + f" {column.type.compile(engine.dialect)}"
+                        )
+
+                for index in table.indexes:
+                    if index.name in indexes:
+                        continue
+
+                    # older versions could insert the same key twice, keep the
+                    # newest row or the unique index cannot be created
+                    if index.unique:
+                        keys = ", ".join(column.name for column in index.columns)
+                        conn.exec_driver_sql(
+                            f"DELETE FROM {table.name} WHERE id NOT IN"
+                            + f" (SELECT MAX(id) FROM {table.name} GROUP BY {keys})"
+                        )
+
+                    index.create(conn)
+
     def serve_forever(self):
+        # own thread and session, so callers never wait on a commit
         session = self.Session()
-        log_buffer = []
 
-        while self.running:
+        while self.running or not self.command_queue.empty():
             try:
-                action, data = self.command_queue.get(timeout=1)
-                if action == 'write':
-                    table_name, log_data = data
-                    table = self._get_table(table_name)
-                    log_buffer.append((table, log_data))
-                    if len(log_buffer) >= self.batch_size:
-                        self._batch_write(session, log_buffer)
-                        log_buffer.clear()
-                elif action == 'read':
-                    table_name, query, params, callback = data
-                    result = session.execute(query, params).fetchall()
-                    callback(result)
+                rows = [self.command_queue.get(timeout=1)]
             except queue.Empty:
-                continue  # Timeout reached, continue processing
+                continue  # timeout reached, check if still running
+
+            while len(rows) < self.batch_size:
+                try:
+                    rows.append(self.command_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.batch_write(session, rows)
 
-        if log_buffer:
-            self._batch_write(session, log_buffer)
         session.close()
 
+    def batch_write(self, session, rows):
+        tables = {}
+        for table, values in rows:
+            tables.setdefault(table, []).append(values)
+
+        try:
+            for table, values in tables.items():
+                session.execute(insert(table), values)
+            session.commit()
+
+        except Exception as err:
+            session.rollback()
+
+            # not through logging, the sqlite handler would queue it right back
+            print(
+                f"dropped {len(rows)} rows, unexpected {err=}, {type(err)=}",
+                file=sys.stderr,
+            )
+
     def shutdown(self):
         self.running = False
 
-    def update(self, key, value):
-        row = self.session.query(Setting).filter_by(key=key).first()
-        dt = datetime.utcnow()
+    def write(self, table, values):
+        self.command_queue.put((table, values))
 
-        if row:
-            row.value = value
-            row.updated_on = dt
+    def get(self, key):
+        return self.session.execute(_SETTING_BY_KEY, {"key": key}).scalar()
 
-        else:
-            row = Setting(
-                key=key,
-                value=value,
-                created_on=dt,
-                updated_on=dt,
+    def get_values(self, keys):
+        # plain rows, for read only paths that do not need orm entities
+        rows = self.session.execute(_SETTING_VALUES_BY_KEYS, {"keys": list(keys)})
+        return {row.key: row for row in rows}
+
+    def update(self, key, value, blob=None, commit=True):
+        # one upsert on the unique key, instead of a select then insert or update
+        dt = datetime.utcnow()
+        statement = insert(Setting).values(
+            key=key, value=value, blob=blob, created_on=dt, updated_on=dt
+        )
+        columns = ("value", "blob", "updated_on")
+
+        self.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[Setting.key],
+                set_={column: statement.excluded[column] for column in columns},
             )
-            self.session.add(row)
+        )
+
+        if commit:
+            self.session.commit()
 
-        self.session.commit()
+        return dt
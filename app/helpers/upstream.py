@@ -0,0 +1,119 @@
+import logging
+import random
+import threading
+import time
+
+import httpx
+
+
+# same headers on every forward of the dns and doh servers, built once
+DNS_JSON_HEADERS = {
+    "accept": "application/dns-json",
+    "accept-encoding": "gzip",
+}
+DNS_MESSAGE_HEADERS = {
+    "content-type": "application/dns-message",
+    "accept": "application/dns-message",
+    "accept-encoding": "gzip",
+}
+
+
+def _retryable(error):
+    # the target is down or overloaded, worth another try on a different one,
+    # any other 4xx is about the query itself and would fail there as well
+    if isinstance(error, httpx.TransportError):
+        return True
+
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status == 429
+
+    return False
+
+
+class Upstream:
+    # one pooled client for every forwarded query, and a moving average of the
+    # latency per doh target so most queries go to the fastest healthy one,
+    # failing targets sit out for a backoff that doubles per failure
+
+    def __init__(self, targets, timeout=9.0, retries=1):
+        self.targets = tuple(targets)
+        self.scores = {target: 0.0 for target in self.targets}
+        self.failures = {target: 0 for target in self.targets}
+        self.retry_at = {target: 0.0 for target in self.targets}
+        self.lock = threading.Lock()
+        self.random = random.Random()
+        self.timeout = timeout
+        self.retries = retries
+
+        # the longest a forward can take, every try timing out
+        self.deadline = timeout * (retries + 1)
+
+        # http/2 multiplexes concurrent queries over one connection per target
+        self.client = httpx.Client(
+            http2=True,
+            timeout=httpx.Timeout(timeout, connect=2.0),
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=300,
+            ),
+        )
+
+    def pick(self):
+        # every target backing off means all are down, so try them anyway
+        now = time.monotonic()
+        targets = [
+            target for target in self.targets if self.retry_at[target] <= now
+        ] or self.targets
+
+        # now and then try another target, so a recovered one gets re-measured
+        if len(targets) > 1 and self.random.random() < 0.2:
+            return self.random.choice(targets)
+
+        return min(targets, key=self.scores.__getitem__)
+
+    def record(self, target, elapsed, failed=False):
+        with self.lock:
+            self.scores[target] = 0.8 * self.scores[target] + 0.2 * elapsed
+
+            if not failed:
+                self.failures[target] = 0
+                return
+
+            self.failures[target] += 1
+            backoff = min(2 ** self.failures[target], 60)
+            self.retry_at[target] = time.monotonic() + backoff
+
+    def request(self, method, target, retries=None, **kwargs):
+        if retries is None:
+            retries = self.retries
+
+        start = time.monotonic()
+
+        try:
+            response = self.client.request(method, target, **kwargs)
+            response.raise_for_status()
+
+        except Exception as e:
+            if not _retryable(e):
+                raise
+
+            # a failure counts as the worst case latency
+            self.record(target, self.timeout, failed=True)
+
+            others = [other for other in self.targets if other != target]
+            if not retries or not others:
+                raise
+
+            fallback = self.random.choice(others)
+            logging.warning(
+                f"{target} failed with {type(e).__name__}, retrying on {fallback}"
+            )
+            return self.request(method, fallback, retries - 1, **kwargs)
+
+        self.record(target, time.monotonic() - start)
+        return response
+
+    def close(self):
+        self.client.close()
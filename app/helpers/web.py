@@ -14,7 +14,7 @@ from sqlalchemy import or_
 from .configs import Config
 from .dns import DNSServer
 from .doh import DOHServer
-from .models import AdsBlockList, AdsBlockLog, Setting
+from .models import AdsBlockList, AdsBlockLog
 from .sqlite import SQLite
 
 
@@ -52,14 +52,10 @@ def config():
     with file.open("r") as f:
         config_file["data"] = "".join(f.readlines())
 
-    sha256 = hashlib.sha256()
     with file.open("rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            sha256.update(chunk)
+        config_file["sha256"] = hashlib.file_digest(f, "sha256").hexdigest()
 
-    config_file["sha256"] = sha256.hexdigest()
-
-    row = sqlite.session.query(Setting).filter_by(key="config-sha256").first()
+    row = sqlite.get("config-sha256")
     if row.value != config_file["sha256"]:
         config_file["mismatched"] = True
 
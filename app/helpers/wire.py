@@ -0,0 +1,189 @@
+import functools
+import logging
+
+import dns.message
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+
+# plain hostname bytes, anything else is left to dnspython to parse and escape
+_LABEL_BYTES = frozenset(
+    b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_"
+)
+
+# record type of the edns pseudo record
+_OPT = b"\x00\x29"
+
+
+@functools.lru_cache(maxsize=128)
+def type_text(rdtype):
+    # the same few record types come in on nearly every query
+    return dns.rdatatype.to_text(rdtype)
+
+
+def parse_question(data):
+    # name and type of a single question query, read straight from the wire,
+    # or None when the full parser is needed
+    if len(data) < 17 or data[4:6] != b"\x00\x01":
+        return None
+
+    labels = []
+    index = 12
+
+    while index < len(data) and data[index]:
+        length = data[index]
+        label = data[index + 1 : index + 1 + length]
+
+        # compression pointers, truncated or escaped labels
+        if length > 63 or len(label) < length or not _LABEL_BYTES.issuperset(label):
+            return None
+
+        labels.append(label.decode())
+        index += length + 1
+
+    if index + 5 > len(data):
+        return None
+
+    query_name = ".".join(labels) + "."
+    query_type = type_text(int.from_bytes(data[index + 1 : index + 3], "big"))
+
+    return query_name, query_type
+
+
+def name_end(data, index):
+    # offset just past the name starting at index, or None when it does not fit
+    while index < len(data):
+        length = data[index]
+
+        if length == 0:
+            return index + 1
+
+        if length >= 0xC0:  # compression pointer, always the last label
+            return index + 2
+
+        index += length + 1
+
+    return None
+
+
+def question_end(data):
+    # offset just past the first question, or None when it does not fit
+    index = name_end(data, 12)
+    if index is None:
+        return None
+
+    index += 4
+    return index if index <= len(data) else None
+
+
+def records(data):
+    # start, type offset and end of every record past the questions, up to the
+    # first one that does not fit
+    index = 12
+    for _ in range(int.from_bytes(data[4:6], "big")):
+        index = name_end(data, index)
+        if index is None:
+            return
+
+        index += 4
+
+    for _ in range(sum(int.from_bytes(data[i : i + 2], "big") for i in (6, 8, 10))):
+        start = index
+        index = name_end(data, index)
+        if index is None or index + 10 > len(data):
+            return
+
+        end = index + 10 + int.from_bytes(data[index + 8 : index + 10], "big")
+        yield start, index, end
+        index = end
+
+
+def ttl_offsets(data):
+    # offsets of every record ttl, skipping the edns opt pseudo record, so a
+    # cached reply can be aged without parsing it again
+    return tuple(
+        index + 4 for _, index, _ in records(data) if data[index : index + 2] != _OPT
+    )
+
+
+def strip_opt(data):
+    # the reply without its trailing edns opt record, the cookie and client
+    # subnet options in it belong to the client that asked first
+    for start, index, end in records(data):
+        if data[index : index + 2] == _OPT and end == len(data):
+            additional = int.from_bytes(data[10:12], "big") - 1
+            return data[:10] + additional.to_bytes(2, "big") + data[12:start]
+
+    return data
+
+
+def dnssec_ok(data):
+    # the do bit of the query edns opt record
+    for _, index, _ in records(data):
+        if data[index : index + 2] == _OPT:
+            return bool(data[index + 6] & 0x80)
+
+    return False
+
+
+def age_reply(wire, offsets, age):
+    # count the ttls down by the seconds the reply spent in the cache
+    for offset in offsets:
+        ttl = int.from_bytes(wire[offset : offset + 4], "big")
+        wire[offset : offset + 4] = max(ttl - age, 0).to_bytes(4, "big")
+
+    return wire
+
+
+def make_error(data, rcode):
+    # reply with the query id, opcode, rd bit and question, no records and the
+    # rcode set, without building a dns.message for it
+    if len(data) < 12:
+        return data[:2].ljust(2, b"\x00") + bytes([0x80, rcode]) + bytes(8)
+
+    flags = bytes([0x80 | (data[2] & 0x79), rcode & 0x0F])
+    end = question_end(data) if data[4:6] == b"\x00\x01" else None
+
+    if end is None:
+        return data[:2] + flags + bytes(8)
+
+    return data[:2] + flags + b"\x00\x01" + bytes(6) + data[12:end]
+
+
+def make_custom(custom, ttl=300):
+    # the custom dns answers built once, keyed like the cache, with the id and
+    # flags left to patch_reply
+    answers = {}
+
+    for query_name, address in custom.items():
+        try:
+            rrset = dns.rrset.from_text(
+                query_name, ttl, dns.rdataclass.IN, dns.rdatatype.A, address
+            )
+        except Exception as e:
+            logging.error(f"invalid custom dns: {query_name} {address}, {e}")
+            continue
+
+        for query_type in ("A", "PTR"):
+            query = dns.message.make_query(query_name, query_type)
+            query.flags = 0
+
+            response = dns.message.make_response(query)
+            response.answer.append(rrset)
+
+            answers[f"{query_name}:{query_type}"] = response.to_wire()
+
+    return answers
+
+
+def patch_reply(wire, header, dnssec=False):
+    # a prebuilt reply with the id, opcode, rd and cd bits of the query header,
+    # the ad bit is only kept when the query asked for it with ad or do
+    reply = bytearray(wire)
+    reply[:2] = header[:2]
+    reply[2] = (reply[2] & 0x86) | (header[2] & 0x79)
+
+    keep = 0xAF if dnssec or header[3] & 0x20 else 0x8F
+    reply[3] = (reply[3] & keep) | (header[3] & 0x10)
+    return reply
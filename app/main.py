@@ -5,11 +5,9 @@ import time
 import logging
 from logging.handlers import TimedRotatingFileHandler
 
-from datetime import datetime, timedelta
-
-import cachetools
 import psutil
 
+from helpers.cache import ShardedCache
 from helpers.configs import Config
 from helpers.adapter import Adapter
 from helpers.adsblock import AdsBlock
@@ -18,6 +16,8 @@ from helpers.doh import DOHServer
 from helpers.logging import SQLiteHandler
 from helpers.web import WEBServer
 from helpers.sqlite import SQLite
+from helpers.upstream import Upstream
+from helpers.wire import make_custom
 
 
 # ################################################################################
@@ -63,9 +63,11 @@ def setup_adsblock(config, adsblock, reload=False, force=False):
 
 def setup_cache(config, sqlite):
     # set up the caching
+    # entries live for their shortest record ttl, capped by the configured ttl
     if config.cache.enable:
-        config.cache.cache = cachetools.TTLCache(
-            maxsize=config.cache.max_size, ttl=config.cache.ttl
+        config.cache.cache = ShardedCache(
+            maxsize=config.cache.max_size,
+            ttu=lambda key, value, now: now + min(value["ttl"], config.cache.ttl),
         )
 
     logging.info(
@@ -96,6 +98,26 @@ def setup_logging(config, sqlite):
         logging.getLogger(logger).setLevel(logging.WARNING)
 
 
+def setup_servers(config, adsblock, servers):
+    # hand the reloaded lists and settings to the running servers
+    for server in servers:
+        server.allowed_domains = adsblock.allowed_domains
+        server.blocked_domains = adsblock.blocked_domains
+        server.blocked_wildcard = config.adsblock.wildcard
+
+        server.dns_custom = config.dns.custom
+        server.custom_answers = make_custom(config.dns.custom)
+        server.target_mode = config.dns.target_mode
+
+        # a new pool only when the targets change, closing the old one after
+        # the swap fails the few forwards still in flight on it
+        if server.target_doh != config.dns.target_doh:
+            upstream = server.upstream
+            server.target_doh = config.dns.target_doh
+            server.upstream = Upstream(config.dns.target_doh)
+            upstream.close()
+
+
 # ################################################################################
 # main routine
 
@@ -103,7 +125,9 @@ def setup_logging(config, sqlite):
 def main():
     config = Config()
     sqlite = SQLite(config.sqlite.uri)
-    config.sync(sqlite.session)
+    sqlite_thread = threading.Thread(target=sqlite.serve_forever, daemon=True)
+    sqlite_thread.start()
+    config.sync(sqlite)
 
     adsblock = AdsBlock(sqlite, config.adsblock.reload)
 
@@ -114,8 +138,12 @@ def main():
     setup_cache(config, sqlite)
     setup_adsblock(config, adsblock)
 
-    dns_server = DNSServer(config, sqlite, adsblock.blocked_domains)
-    doh_server = DOHServer(config, sqlite, adsblock.blocked_domains)
+    dns_server = DNSServer(
+        config, sqlite, adsblock.blocked_domains, adsblock.allowed_domains
+    )
+    doh_server = DOHServer(
+        config, sqlite, adsblock.blocked_domains, adsblock.allowed_domains
+    )
     web_server = WEBServer(config, sqlite)
 
     # set up the threading
@@ -129,24 +157,23 @@ def main():
             threads.append(thread)
 
         setup_adsblock(config, adsblock, reload=True)
+        setup_servers(config, adsblock, [dns_server, doh_server])
         logging.info("press ctrl+c to quit!")
 
         while not event.is_set():
-            dt = datetime.now()
+            # monotonic, so a wall clock change does not skew the schedule
+            deadline = time.monotonic() + 600
 
-            if config.sync(sqlite.session):
+            if config.sync(sqlite):
                 setup_adsblock(
                     config, adsblock, reload=True, force=config.adsblock.reload
                 )
 
-                for server in [dns_server, doh_server]:
-                    server.blocked_domains = adsblock.blocked_domains
-
+                setup_servers(config, adsblock, [dns_server, doh_server])
                 logging.info(f"{config.filename} has changed, reloaded!")
 
             # cron style scheduling
-            next = dt + timedelta(minutes=10)
-            sleep = (next - datetime.now()).total_seconds()
+            sleep = deadline - time.monotonic()
 
             if sleep > 0:
                 time.sleep(sleep)
@@ -168,9 +195,16 @@ def main():
             thread.join()
 
         # adapter.reset_dns(cfg.dns.interface_name)
-        sqlite.session.close()
+        for server in [dns_server, doh_server]:
+            server.upstream.close()
+
+        adsblock.close()
         logging.info("sayonara!")
 
+        sqlite.shutdown()
+        sqlite_thread.join()
+        sqlite.session.close()
+
 
 # ################################################################################
 # where it all begins